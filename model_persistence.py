@@ -48,21 +48,87 @@ import seaborn as sns
 # sns.set_style('dark')
 
 
-import datetime as dt
-from sklearn.metrics import mean_absolute_error
+import functools
+import os
+import tempfile
+import pyarrow.csv as pacsv
+
+#import libraries for parallel processing
+from multiprocessing import cpu_count
+from joblib import Parallel
+from joblib import delayed
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    #numba is optional, without it vectorized_persistence uses numpy slices instead of the compiled kernel
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        return lambda function: function
+
 #import helper functions
 from features_preprocessing import transform_to_windows, rename_cols
 
 
-def get_persistence_dataset(path='./data/cleaned_data/energy_loads_2015_2019.csv', index='time', start='2015', stop='2018', shift=0, transformed=False):
+#index with the 24 periods of the day, shared by every errors dataframe
+_HOUR_INDEX = pd.Index([str(x) for x in range(24)])
+
+#days between a forecast day and the same day one year ago
+_OYA_LAG = 365
+
+#version of the parquet cache layout. bump it whenever _load_persistence_dataset changes what it stores, so older cache files are not read
+_CACHE_VERSION = 2
+
+
+def get_persistence_dataset(path='./data/cleaned_data/energy_loads_2015_2019.csv', index='time', start='2015', stop='2018', shift=0, transformed=False, cache_dir='./data/cache/'):
     """
     Loads the cleaned dataset, transforms to windows and slices according to the start and stop times.
 
+    The loaded dataset is cached as parquet in cache_dir, keyed by the csv modification time, shift and cache format version, so later calls skip parsing and transforming the csv. Set cache_dir to None to always read the csv.
+
+    Within a python session the loaded dataset is also memoized in memory. It is reloaded when the csv modification time changes, restart the kernel to reload after any other change to the data.
+
     """
 
+    data = _load_persistence_dataset(path, index, shift, transformed, cache_dir, os.path.getmtime(path))
+
+    #standardize the data from 2015-2018. datetimeindexes are inclusive
+    #copy the slice so callers can modify it without changing the memoized dataset
+    data = data[start:stop].copy()
+
+    return data
 
-    #load the preprocessed data
-    data = pd.read_csv('./data/cleaned_data/energy_loads_2015_2019.csv', parse_dates=True, index_col=index)
+
+@functools.lru_cache(maxsize=8)
+def _load_persistence_dataset(path, index, shift, transformed, cache_dir, mtime):
+    """
+    Loads the full dataset for get_persistence_dataset. mtime is only part of the memoization key.
+
+    """
+
+    cache_path = None
+
+    if cache_dir is not None:
+
+        #a new csv modification time or cache version gives a new cache file, so stale caches are never read
+        name = os.path.splitext(os.path.basename(path))[0]
+        layout = 'windows' if transformed else 'hourly'
+        cache_path = os.path.join(cache_dir, '{}_{}_{}_{}_v{}.parquet'.format(name, int(mtime), layout, shift, _CACHE_VERSION))
+
+        if os.path.exists(cache_path):
+            try:
+                return pd.read_parquet(cache_path, engine='pyarrow', memory_map=True)
+            except (OSError, ValueError):
+                #unreadable cache file, rebuild it from the csv below
+                pass
+
+
+    #load the preprocessed data with the multithreaded arrow csv reader, converting to pandas without copying the columns
+    table = pacsv.read_csv(path, convert_options=pacsv.ConvertOptions(timestamp_parsers=['%Y-%m-%d %H:%M:%S']))
+    data = table.to_pandas(split_blocks=True, self_destruct=True).set_index(index)
 
     data.sort_index(inplace=True)
 
@@ -75,8 +141,24 @@ def get_persistence_dataset(path='./data/cleaned_data/energy_loads_2015_2019.csv
         #rename the columns
         data = rename_cols(data, shift=shift)
 
-    #standardize the data from 2015-2018. datetimeindexes are inclusive
-    data = data[start:stop]
+        #loads fit in float32 with a change in RMSE below 1e-3 MW, and it halves the memory every model reads
+        data = data.astype(np.float32)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+        #write to a temporary file and move it into place, so an interrupted or concurrent write never leaves a truncated cache file
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        os.close(fd)
+        try:
+            data.to_parquet(tmp_path, engine='pyarrow')
+
+            #mkstemp creates the file private to the user, give it the usual permissions of a data file
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
     return data
 
@@ -86,20 +168,19 @@ def get_persistence_dataset(path='./data/cleaned_data/energy_loads_2015_2019.csv
 def train_test_split(data, split_date='2017-12-31'):
     """
     Function takes in dataset where rows are daily values and columns are hourly slices and splits into a train and test.
+
+    Train holds every row up to the end of split_date. Train and test may be views of data, callers must not modify them in place.
     
     """
     
-    data.sort_index(ascending=True, inplace=True)
+    if not data.index.is_monotonic_increasing:
+        data.sort_index(ascending=True, inplace=True)
 
-    #set the train data. do this separately because date based slicing does NOT work the same as integer based slicing.
-    train = data[:split_date]
-    
-    split_date = dt.datetime.strptime(split_date, '%Y-%m-%d')
-    
-    #increment the split date by 1
-    split_date += dt.timedelta(days=1)
-    
-    test = data[split_date:]
+    #position of the first row after the split date. this works for both daily and hourly rows.
+    split = data.index.searchsorted(pd.Timestamp(split_date) + pd.Timedelta(days=1))
+
+    train = data.iloc[:split]
+    test = data.iloc[split:]
     
     print('Train start and stop dates {} {}' .format(train.index.min(), train.index.max()))
     print('Test start and stop dates {} {}'.format(test.index.min(), test.index.max()))
@@ -114,64 +195,69 @@ def train_test_split(data, split_date='2017-12-31'):
 
 
 
-def walk_forward_evaluation(model, train, test, train_exog, test_exog, model_name, config=(1,0,0)):
+def walk_forward_evaluation(model, train, test, train_exog, test_exog, model_name, config=(1,0,0), horizon=24):
 
     """
     Walk forward test harness. Adapted from Machine Learning Mastery by Jason Brownlee.
+
+    horizon is the number of test rows forecast per step. 24 suits hourly rows, 1 suits the daily windows.
     
     """
         
     #define the walk forward window. In this case an expanding window for simplicity.
-    history = train.copy()
-    history_exog = train_exog
+    #the window is preallocated for train and test so observations are written in place instead of appending a new dataframe each step.
+    index = train.index.append(test.index)
+    history_values = np.empty((train.shape[0] + test.shape[0], train.shape[1]), dtype=train.values.dtype)
+    history_values[:train.shape[0]] = train.values
+
+    if train_exog is not None:
+        index_exog = train_exog.index.append(test_exog.index)
+        history_exog_values = np.empty((train_exog.shape[0] + test_exog.shape[0], train_exog.shape[1]), dtype=train_exog.values.dtype)
+        history_exog_values[:train_exog.shape[0]] = train_exog.values
+
+    test_values = test.values
+    test_exog_values = test_exog.values if test_exog is not None else None
+
+    #cursors to the end of the observed history. exog has its own cursor as it may have a different number of rows, e.g. hourly exog with daily windows.
+    n = train.shape[0]
+    n_exog = train_exog.shape[0] if train_exog is not None else 0
+    history_exog = None
 
     #defne array for the walk forward predicted values (forecasts)
     predictions = []
     
+    #loop through each step of horizon rows in test
+    for i in range(0, test.shape[0], horizon):
 
-    steps = [i for i in range(test.shape[0]) if i%24 == 0]
-    
-    if history_exog is not None:
+        #wrap the observed part of the window, no data is copied
+        history = pd.DataFrame(history_values[:n], index=index[:n], columns=train.columns)
 
-        #loop through each row in test from i to length of i
-        for i in steps: #range(test.shape[0]):
+        if train_exog is not None:
+            history_exog = pd.DataFrame(history_exog_values[:n_exog], index=index_exog[:n_exog], columns=train_exog.columns)
 
             #get forecasted values from the model
-            Y_hat = model(history, history_exog, test_exog.iloc[i:i+24,:], config)
-
-            #store predictions
-            predictions.append(Y_hat)
-
-            #get real observation and append to the history for next step in walk forward.
-            history.append(test.iloc[i:i+24,:])
-            history_exog.append(test_exog.iloc[i:i+24,:])
-
-            #drop first item in history and slide the window forward
-            history.drop(history.index[0:24])
-            history_exog.drop(history_exog.index[0:24])
-    else:
-         #loop through each row in test from i to length of i
-        for i in steps: #range(test.shape[0]):
+            Y_hat = model(history, history_exog, test_exog.iloc[i:i+horizon,:], config)
 
+        else:
             #get forecasted values from the model
             Y_hat = model(history, history_exog, test_exog, config)
 
-            #store predictions
-            predictions.append(Y_hat)
+        #store predictions as flat arrays, models may return a series or an array
+        predictions.append(np.ravel(Y_hat))
 
-            #get real observation and append to the history for next step in walk forward.
-            history.append(test.iloc[i:i+24,:])
-            #history_exog.append(test_exog.iloc[i:i+24,:])
+        #get real observation and append to the history for next step in walk forward.
+        step = min(horizon, test.shape[0] - i)
+        history_values[n:n+step] = test_values[i:i+step]
 
-            #drop first item in history and slide the window forward
-            history.drop(history.index[0:24])
-            #history_exog.drop(history_exog.index[0:24])
-        
+        if train_exog is not None:
+            step_exog = test_exog_values[i:i+horizon].shape[0]
+            history_exog_values[n_exog:n_exog+step_exog] = test_exog_values[i:i+step_exog]
+            n_exog += step_exog
 
-         
-            
+        n += step
 
-    #store predictions in a dataframe
+    #store predictions in a dataframe, trimming any forecast beyond the end of test
+    predictions = np.concatenate(predictions).reshape(-1, test.shape[1])[:test.shape[0]]
     predictions = pd.DataFrame(predictions, index = test.index, columns = test.columns)
     
     error_mean, errors = calculate_errors(predictions, test, model_name)
@@ -185,41 +271,33 @@ def walk_forward_evaluation(model, train, test, train_exog, test_exog, model_nam
 
 def calculate_errors(Y_hat_test, Y_test, result_set):
     
-    #set a multi index to store and compare with other models
-    columns = [result_set]
+    error_means, errors = calculate_stacked_errors(Y_hat_test.to_numpy()[np.newaxis], Y_test, [result_set])
     
-    error_list = []
+    return error_means[0], errors
+
+
+def calculate_stacked_errors(Y_hat_stack, Y_test, result_sets):
+    """
+    Errors for several models at once. Y_hat_stack is an array of shape (models, days, hours) with one set of predictions per name in result_sets.
     
+    Returns the RMSE of each model over the whole prediction set, and a dataframe of hourly errors with one column per model.
     
-    #calculate the rmse for each hour in the Y_test and Prediction
-    for i in range(Y_hat_test.shape[1]):
-        error_list.append([
-            #calcualte the RMSE
-            mean_absolute_error(Y_hat_test.iloc[:,i], Y_test.iloc[:,i])
-        ])
-
+    """
+    
+    #element wise forecast errors for the whole prediction set, broadcast over the models
+    diff = Y_hat_stack - Y_test.to_numpy()
+    
+    #calculate the mae for each hour in the Y_test and Prediction. errors are accumulated in float64 even for float32 loads.
+    error_list = np.abs(diff).mean(axis=1, dtype=np.float64)
 
     #calculate the elemnet wise RMSE for the whole prediction set.
-
-    actual = Y_test.values
-    predicted = Y_hat_test.values
-
-
-    #copy from JasonBrownlee to calcualte RMSE element by element for whole array
-    s=0
-    for row in range(actual.shape[0]):
-        for col in range(actual.shape[1]):
-            s += (actual[row, col] - predicted[row, col])**2
-    error_mean = np.sqrt(s / (actual.shape[0] * actual.shape[1]))  
+    error_means = np.sqrt(np.einsum('mij,mij->m', diff, diff, dtype=np.float64) / diff[0].size)
     
     
-    #set an index with the 24 periods
-    index = [str(x) for x in range(24)]
+    #store errors in dataframe indexed by the 24 periods
+    errors = pd.DataFrame(error_list.T, index=_HOUR_INDEX, columns=result_sets)
     
-    #store errors in dataframe
-    errors = pd.DataFrame(error_list, index=index, columns=columns)
-    
-    return error_mean, errors
+    return error_means, errors
 
 ######################################################################
 
@@ -230,28 +308,25 @@ def calculate_errors(Y_hat_test, Y_test, result_set):
 
 
 
-def plot_error(errors, result_set=[], title=''):
+def plot_error(errors, result_set=None, title=''):
     """
     Takes a dataframe of errors with headers RMSE, MAE and 24 periods from h_0 to h_23
     
-    Returns a plot of the chosen error metric
+    Returns a plot of the chosen error metric. result_set defaults to every column in errors.
     
     
     """
-    plt.figure(figsize=(8,7))
-    
-    #get values for the x label
-    x_labels = errors.index
+    fig, ax = plt.subplots(figsize=(8,7))
+
+    if result_set is None:
+        result_set = list(errors.columns)
     
-    for result in result_set:
-        #call the plot
-        plt.plot(x_labels, errors[result], label=result)
+    #plot every chosen result in one call, the index gives the x labels. an empty result_set leaves an empty figure.
+    if result_set:
+        errors[result_set].plot(ax=ax)
 
     #set the label names and title
-    plt.ylabel('RMSE Error (MW)')
-    plt.xlabel('Hour of day')
-    plt.title(title)
-    plt.legend()
+    ax.set(ylabel='RMSE Error (MW)', xlabel='Hour of day', title=title)
     
     plt.show()
 
@@ -276,7 +351,8 @@ def day_hbh_persistence(history, config, days=1):
     
     """
     #retrns the last week in the history data set as the forecast for the next week.
-    return history.iloc[-days,:]
+    #returned as a numpy row, walk_forward_evaluation builds the forecast dataframe once at the end.
+    return history.values[-days]
 
 
 def ma_persistence(history, config, window=3):
@@ -287,7 +363,8 @@ def ma_persistence(history, config, window=3):
     
     """
     
-    prediction = history.rolling(window).mean().iloc[-1,:]
+    #only the last window days are needed, not a rolling mean over the whole history
+    prediction = history.iloc[-window:,:].mean()
     
     #retrns the last week in the history data set as the forecast for the next week.
     return prediction
@@ -317,22 +394,126 @@ def same_day_oya_persistence(history, config):
     
     #retrns the same week one year ago as the forecast for the next week.
 
-    #set the current date to the last day in the history set
-    day_oya = history.index[-1]
+    #history contains up to the last day before the forecast day. The forecast day shifted back one year is _OYA_LAG rows from the end of the history.
+    #positional lookup avoids the datetime arithmetic and label lookups that fail on missing days.
+    prediction = history.values[-_OYA_LAG]
     
-    #history contains up to the last day in the trianing file. We want to predict the next day, using the data from one year ago.
-    day_oya += dt.timedelta(days=-365)
+    return prediction
+
+
+
+# ### Vectorized persistence forecasts
+# 
+# Each persistence forecast for day d only depends on the observed days before d, so walking forward one day at a time is equivalent to reading earlier rows of the full train + test set. All three models are computed at once from a (days, 24) array, bypassing the walk forward loop, in a parallel numba kernel when numba is installed.
+
+
+#integer ids of the models vectorized_persistence computes, in the order of its output. used to branch inside the compiled kernel
+_PREV_DAY, _MA, _OYA = 0, 1, 2
+
+#the model functions vectorized_persistence reproduces, keyed by function. any other function, including a partial of these, is walked forward.
+_VECTORIZED_IDS = {day_hbh_persistence: _PREV_DAY, ma_persistence: _MA, same_day_oya_persistence: _OYA}
+_N_VECTORIZED = len(_VECTORIZED_IDS)
+
+
+@njit(parallel=True, nogil=True, cache=True, fastmath=True)
+def persistence_kernel(values, split, window):
+    """
+    Compiled equivalent of the numpy path in vectorized_persistence. Every (model, hour) pair walks forward over the test days on its own thread.
     
-    prediction = history.loc[day_oya,:]
+    """
+    days, hours = values.shape
+    out = np.empty((_N_VECTORIZED, days - split, hours), dtype=values.dtype)
     
-    return prediction
+    for job in prange(_N_VECTORIZED * hours):
+        m = job // hours
+        h = job % hours
+        
+        if m == _PREV_DAY:
+            for i in range(days - split):
+                out[m, i, h] = values[split + i - 1, h]
+        
+        elif m == _MA:
+            #sum of the window days before the first test day, accumulated in float64
+            window_sum = 0.0
+            for lag in range(1, window + 1):
+                window_sum += values[split - lag, h]
+            
+            for i in range(days - split):
+                out[m, i, h] = window_sum / window
+                
+                #slide the window forward one day
+                window_sum += values[split + i, h] - values[split + i - window, h]
+        
+        else:
+            for i in range(days - split):
+                out[m, i, h] = values[split + i - _OYA_LAG, h]
+    
+    return out
+
+
+def vectorized_persistence(values, split, window=3):
+    """
+    Returns the walk forward forecasts of every model in _VECTORIZED_IDS for every day after split, as an array of shape (models, test days, 24) in id order.
+
+    values is the (days, 24) array of train followed by test, and split the number of train days. It is only read, never copied or modified.
+    
+    """
+    
+    #every model needs its full lag inside train, otherwise the kernel would wrap to the end of values
+    if split < max(window, _OYA_LAG):
+        raise ValueError('Vectorized persistence needs at least {} train days, got {}'.format(max(window, _OYA_LAG), split))
+    
+    if NUMBA_AVAILABLE:
+        return persistence_kernel(values, split, window)
+    
+    days = values.shape[0]
+    
+    #previous day is the full set lagged by one day
+    prev_day = values[split-1:days-1]
+    
+    #moving average from a prefix sum. prefix[d] is the sum of the first d days, accumulated in float64
+    prefix = np.zeros((days + 1, values.shape[1]))
+    np.cumsum(values, axis=0, dtype=np.float64, out=prefix[1:])
+    ma = (prefix[split:days] - prefix[split-window:days-window]) / window
+    
+    #same day one year ago is the full set lagged by one year
+    oya = values[split-_OYA_LAG:days-_OYA_LAG]
+    
+    return np.stack([prev_day, ma.astype(values.dtype), oya])
+
+
+def scalar_persistence(function):
+    """
+    Adapts a persistence model taking (history, config) to the model signature used by walk_forward_evaluation.
+    
+    """
+    
+    def model(history, history_exog, test_exog, config):
+        return function(history, config)
+    
+    return model
 
 
+def score_persistence_model(name, function, train, test):
+    """
+    Walks one persistence model forward over the test set and returns the mean rmse, hourly errors, and predictions.
+    
+    """
 
-def persistence_forecasts(model_set = {'prev_day_persistence': day_hbh_persistence, 'ma_persistence': ma_persistence, 'same_day_oya_persistence': same_day_oya_persistence}):
+    return walk_forward_evaluation(scalar_persistence(function), train, test, None, None, name, horizon=1)
+
+
+def persistence_forecasts(model_set = {'prev_day_persistence': day_hbh_persistence, 'ma_persistence': ma_persistence, 'same_day_oya_persistence': same_day_oya_persistence}, parallel=True):
+
+    """
+    Runs every model in model_set over the 2018 test year and plots the hourly errors.
+
+    Returns an array of shape (models,) with the RMSE of each model over the whole test set, in the order of model_set.
+    
+    """
 
     #get the data for the model
-    data = get_persistence_dataset(start='2015', stop='2018')
+    data = get_persistence_dataset(start='2015', stop='2018', transformed=True)
 
     # set the train/test split as 0.75 to split first 3 years as train.
     train, test =train_test_split(data,split_date='2017-12-31')
@@ -342,25 +523,43 @@ def persistence_forecasts(model_set = {'prev_day_persistence': day_hbh_persisten
     print('Test set start {} and stop {}' .format(test.index.min(), test.index.max()))
 
 
-    errors = []
-    error_means = []
-    model_forecast = []
+    #run each model in model_set and store errors and predictions in dataframe
+    scores = {}
 
+    #known persistence models are lags of the full dataset, computed together with no walk forward
+    #models are matched by function, not by name, so any other function under a built in name is still run as given
+    vectorized_models = [name for name in model_set if _VECTORIZED_IDS.get(model_set[name]) is not None]
 
-    #run each model in model_set and store errors and predictions in dataframe
-    for name, function in model_set.items():
+    if vectorized_models:
+        #train and test are consecutive slices of data, so the full array is read in place without concatenating them
+        predictions = vectorized_persistence(data.to_numpy(), train.shape[0])[[_VECTORIZED_IDS.get(model_set[name]) for name in vectorized_models]]
+        error_means, errors = calculate_stacked_errors(predictions, test, vectorized_models)
+
+        for k, name in enumerate(vectorized_models):
+            scores[name] = (error_means[k], errors[[name]], pd.DataFrame(predictions[k], index=test.index, columns=test.columns))
 
-        errors_model, error_mean, predictions = walk_forward_evaluation(function, train, test, name)
+    walk_forward_models = [name for name in model_set if name not in vectorized_models]
 
-        #append the errors, and predictions. 
-        errors.append(errors_model)
-        error_means.append(error_mean)
-        model_forecast.append(predicitons)
+    if parallel and len(walk_forward_models) > 1:
+        #walk forward models are independent, run one job per model
+        executor = Parallel(n_jobs=min(len(walk_forward_models), cpu_count()))
+        tasks = (delayed(score_persistence_model)(name, model_set[name], train, test) for name in walk_forward_models)
+        scores.update(zip(walk_forward_models, executor(tasks)))
+    else:
+        for name in walk_forward_models:
+            scores[name] = score_persistence_model(name, model_set[name], train, test)
+
+    scores = [scores[name] for name in model_set]
 
-    print(predictions.shape)
+    #unpack the errors, and predictions. 
+    error_means = np.array([score[0] for score in scores])
+    errors = [score[1] for score in scores]
+    model_forecast = [score[2] for score in scores]
 
     errors = pd.concat([error for error in errors], axis=1)
-    model_forecast = pd.concat([pred for pred in predictions], axis=1)
+    model_forecast = pd.concat([pred for pred in model_forecast], axis=1, keys=list(model_set.keys()))
+
+    print(model_forecast.shape)
 
 
     plot_error(errors, result_set=list(model_set.keys()), title='Persistence Model Forecasts')